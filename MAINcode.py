@@ -6,17 +6,18 @@
 
 import pandas as pd
 import streamlit as st
-from typing import List, Tuple, Dict, Optional
-import io
-import plotly.express as px
-import re
+from typing import List, Tuple, Dict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # External modules
-from agsparser import analyze_ags_content, _split_quoted_csv, parse_ags_file,find_hole_id_column
-from cleaners import deduplicate_cell, drop_singleton_rows, expand_rows, combine_groups, coalesce_columns, to_numeric_safe, normalize_columns
-from triaxial import generate_triaxial_table, generate_triaxial_with_lithology, calculate_s_t_values, remove_duplicate_tests
-from map_concat import combine_ags_data, build_continuous_intervals, map_group_to_intervals, simplify_weathering_grade
-from excel_util import  add_st_charts_to_excel, build_all_groups_excel, remove_duplicate_tests
+from excel_util import build_all_groups_excel, build_single_sheet_excel, build_triaxial_excel
+from map_concat import combine_ags_data
+from app_common import (
+    parse_and_clean, combine_uploads, load_giu, build_triaxial_summary,
+    render_diagnostics, render_group_tabs, render_st_plot,
+)
 
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -55,7 +56,7 @@ giu_base = st.text_input("Enter GIU base prefix (e.g., GIU123):", value="GIU")
 
 if uploaded_files:
     all_group_dfs: List[Tuple[str, Dict[str, pd.DataFrame]]] = []
-    diagnostics: List[Tuple[str, Dict[str, bool]]] = []
+    diagnostics: List[Tuple[str, Dict[str, str]]] = []
     
     # User inputs GIU base prefix once (outside the loop)
     giu_base = st.text_input(
@@ -64,47 +65,30 @@ if uploaded_files:
         help="This prefix will be added to HOLE_ID for each file (e.g., GIU123_1_BH01)"
     )
 
-    for file_idx, f in enumerate(uploaded_files):
-        file_bytes = f.getvalue()
-        
-        # 1) Diagnostics
-        flags = analyze_ags_content(file_bytes)
-        diagnostics.append((f.name, flags))
-        
-        # 2) Parse into per-group DataFrames
-        raw_groups: Dict[str, pd.DataFrame] = parse_ags_file(file_bytes, f.name)
-        cleaned_groups: Dict[str, pd.DataFrame] = {}
-        
-        # Per-file GIU number (unique per file)
-        giu_no = f"{giu_base}_{file_idx + 1}" if giu_base else f"FILE_{file_idx + 1}"
-        
-        for group_name, df in raw_groups.items():
-            if df is None or df.empty:
-                continue
-            
-            # Cleaning steps (same as before)
-            df = normalize_columns(df)
-            df = drop_singleton_rows(df)
-            df = df.map(deduplicate_cell)
-            coalesce_columns(df, ["DEPTH_FROM", "START_DEPTH"], "DEPTH_FROM")
-            coalesce_columns(df, ["DEPTH_TO", "END_DEPTH"], "DEPTH_TO")
-            to_numeric_safe(df, ["DEPTH_FROM", "DEPTH_TO"])
-            df["SOURCE_FILE"] = f.name
-            
-            # ── IMPORTANT: Add GIU prefixing here ───────────────────────────────
-            df["GIU_NO"] = giu_no 
-            hole_id_col = find_hole_id_column(df.columns)
-            if hole_id_col:
-                df[hole_id_col] = df[hole_id_col].astype(str).str.strip()
-                df["GIU_HOLE_ID"] = giu_no + "_" + df[hole_id_col]
-            
-            cleaned_groups[group_name] = df
-        
+    # Per-file GIU number (unique per file)
+    jobs = [
+        (f.getvalue(), f.name, f"{giu_base}_{file_idx + 1}" if giu_base else f"FILE_{file_idx + 1}")
+        for file_idx, f in enumerate(uploaded_files)
+    ]
+
+    # 1) Diagnostics + 2) parse & clean, one worker per file (cached on the file bytes).
+    # Workers get the script context so st.cache_data / st.warning behave as on the main thread.
+    with ThreadPoolExecutor(
+        max_workers=min(8, len(jobs)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as pool:
+        results = list(pool.map(lambda job: parse_and_clean(*job), jobs))
+
+    for (_, fname, _), (flags, cleaned_groups) in zip(jobs, results):
+        diagnostics.append((fname, flags))
         # Collect this file’s cleaned groups
-        all_group_dfs.append((f.name, cleaned_groups))
+        all_group_dfs.append((fname, cleaned_groups))
 
-    # 9) Combine across files (now includes GIU_NO and GIU_HOLE_ID in every group)
-    combined_groups = combine_groups(all_group_dfs)
+    # 9) Combine across files (now includes GIU_NO and GIU_HOLE_ID in every group).
+    # Cached on the upload ids + GIU numbers rather than on the frames themselves.
+    uploads_key = tuple((f.file_id, job[2]) for f, job in zip(uploaded_files, jobs))
+    combined_groups = combine_uploads(uploads_key, all_group_dfs)
 
     # Now `combined_groups` contains one cleaned DataFrame per AGS group,
     # merged across all uploaded files. You can proceed to triaxial/lithology logic…
@@ -112,11 +96,7 @@ if uploaded_files:
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     # Step 4: Show quick diagnostics results, user should understand not to mix ags3 and ags4
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-    with st.expander("File diagnostics (AGS type & key groups)", expanded=False):
-        diag_df = pd.DataFrame(
-            [{"File": n, **flags} for (n, flags) in diagnostics]
-        )
-        st.dataframe(diag_df, width='stretch')
+    render_diagnostics(diagnostics)
 
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     # Step 5:  Sidebar: downloads and plotting options
@@ -125,10 +105,10 @@ if uploaded_files:
         st.header("Downloads & Plot Options")
 
         if combined_groups:
-            all_xl = build_all_groups_excel(combined_groups)
+            # Built on click (callable data), not on every rerun of the page
             st.download_button(
                 "📥 Download ALL groups (one Excel workbook)",
-                data=all_xl,
+                data=partial(build_all_groups_excel, combined_groups),
                 file_name="ags_groups_combined.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 help="Each AGS group is a separate sheet; all uploaded files are merged."
@@ -140,60 +120,13 @@ if uploaded_files:
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     st.subheader("📋 AGS Groups (merged across all uploaded files)")
     
-    rename_map = {
-        "?ETH": "WETH",
-        "?ETH_TOP": "WETH_TOP",
-        "?ETH_BASE": "WETH_BASE",
-        "?ETH_GRAD": "WETH_GRAD",
-        "?LEGD": "LEGD",
-        "?HORN": "HORN",
-    }
-    tabs = st.tabs(sorted(combined_groups.keys()))
-    for tab, gname in zip(tabs, sorted(combined_groups.keys())):
-        with tab:
-            gdf = combined_groups[gname]
-            st.write(f"**{gname}** — {len(gdf)} rows")
-            st.dataframe(gdf, width='stretch', height=350)
-
-            # Per-group download (Excel)
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                # apply column heading fixes
-                gdf_out = drop_singleton_rows(gdf).rename(columns=rename_map)
-            
-                # apply sheet name fixes
-                safe_sheet = rename_map.get(gname, gname)
-                gdf_out.to_excel(writer, index=False, sheet_name=safe_sheet[:31])
-            st.download_button(
-                label=f"Download {gname} (Excel)",
-                data=buffer.getvalue(),
-                file_name=f"{gname}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key=f"dl_{gname}",
-            )
+    render_group_tabs(combined_groups)
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     # giu file cleaning
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     giu_df = None
     if giu_file is not None:
-        name = giu_file.name.lower()
-        if name.endswith(".csv"):
-            giu_df = pd.read_csv(giu_file)
-        else:
-            giu_df = pd.read_excel(giu_file)
-
-        # NOW giu_df is a DataFrame. Clean it:
-        giu_df = normalize_columns(giu_df)
-
-        if "LOCA_ID" in giu_df.columns and "HOLE_ID" not in giu_df.columns:
-            giu_df = giu_df.rename(columns={"LOCA_ID": "HOLE_ID"})
-
-        giu_df = drop_singleton_rows(giu_df)
-        giu_df = expand_rows(giu_df)
-        giu_df = giu_df.map(deduplicate_cell)
-        coalesce_columns(giu_df, ["DEPTH_FROM" ,"START_DEPTH"], "DEPTH_FROM")
-        coalesce_columns(giu_df, ["DEPTH_TO" ,"END_DEPTH"],     "DEPTH_TO")
-        to_numeric_safe(giu_df, ["DEPTH_FROM" ,"DEPTH_TO"])
+        giu_df = load_giu(giu_file.getvalue(), giu_file.name)
 
         st.write("Cleaned GIU intervals:")
         st.dataframe(giu_df, width='stretch')
@@ -205,78 +138,35 @@ if uploaded_files:
     st.markdown("---")
     st.header("Triaxial Summary & s–t Plots")
 
-    # 1) Build raw triaxial summary
-    tri_df = generate_triaxial_table(combined_groups)
+    if giu_df is None and any(g in combined_groups for g in ("TRIX", "TRET")):
+        st.error("Please upload and clean the GIU table first.")
+        st.stop()
+
+    # 1-5) Triaxial table, lithology, s & t, merge (cached on the uploads, so
+    # plot/filter widget reruns skip the whole pipeline)
+    giu_key = giu_file.file_id if giu_file is not None else None
+    tri_df_with_st, st_df = build_triaxial_summary((uploads_key, giu_key), combined_groups, giu_df)
 
-    if tri_df.empty:
+    if tri_df_with_st.empty:
         st.info("No triaxial data (TRIX/TRET + TRIG/TREG) detected in the uploaded files.")
     else:
-        if giu_df is None:
-            st.error("Please upload and clean the GIU table first.")
-            st.stop()
-        # ─── 2) Normalize IDs & depths ─────────────────────────────────────
-        # Prefer GIU_HOLE_ID if it exists (from prefixing), else HOLE_ID
-        id_col = 'GIU_HOLE_ID' if 'GIU_HOLE_ID' in tri_df.columns else 'HOLE_ID'
-        
-        if id_col in tri_df.columns:
-            tri_df[id_col] = tri_df[id_col].astype(str).str.upper().str.strip()
-            tri_df['HOLE_ID'] = tri_df[id_col]  # Ensure consistent name for display
-        else:
-            st.warning(f"No hole ID column found (tried {id_col}, HOLE_ID). Using 'UNKNOWN'.")
-            tri_df['HOLE_ID'] = 'UNKNOWN'
-        
-        tri_df["SPEC_DEPTH"] = pd.to_numeric(tri_df["SPEC_DEPTH"], errors="coerce")
-
-        # ─── 3) Map lithology from GIU into tri_df ─────────────────────────
-        def map_litho(row):
-            hole, depth = row["HOLE_ID"], row["SPEC_DEPTH"]
-            if pd.isna(hole) or pd.isna(depth):
-                return None
-
-            mask = (
-                    giu_df["HOLE_ID"].str.upper().str.strip().str.endswith(hole)
-                    & (giu_df["DEPTH_FROM"] <= depth)
-                    & (giu_df["DEPTH_TO"]   >= depth)
-            )
-            sub = giu_df.loc[mask]
-            return sub.iloc[0]["LITH"] if not sub.empty else None
-
-        tri_df["LITH"] = tri_df.apply(map_litho, axis=1)
-        st.write(f"🔍 Mapped LITH for {tri_df['LITH'].notna().sum()} / {len(tri_df)} records")
-
-        # ─── 4) Compute s & t ───────────────────────────────────────────────
-
-        st_df = calculate_s_t_values(tri_df)
-
-        # ─── 5) Merge s,t (and LITH) into final summary ────────────────────
-        merge_keys   = [c for c in ["HOLE_ID" ,"SPEC_DEPTH" ,"CELL" ,"PWPF" ,"DEVF"] if c in tri_df.columns]
-        st_cols      = [c for c in ["s" ,"t" ,"s_total" ,"s_effective" ,"s_source" ,"TEST_TYPE" ,"SOURCE_FILE"]
-                        if c in st_df.columns]
-
-        tri_df_with_st = (
-            tri_df
-            .merge(st_df[merge_keys + st_cols], on=merge_keys, how="left")
-            .pipe(remove_duplicate_tests)
-        )
+        st.write(f"🔍 Mapped LITH for {tri_df_with_st['LITH'].notna().sum()} / {len(tri_df_with_st)} records")
 
                 # ─── 6) Display summary ─────────────────────────────────────────────
         st.write(f"**Triaxial summary (with s, t & lithology)** — {len(tri_df_with_st)} rows")
         st.dataframe(tri_df_with_st, use_container_width=True, height=350)  # DEPTH_SOURCE now visible
 
-        # ─── 7) (optional) Excel download with charts ──────────────────────
-        buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-            tri_df_with_st.to_excel(writer, index=False, sheet_name="Triaxial_Summary")
-            st_df.to_excel(writer, index=False, sheet_name="s_t_Values")
-            add_st_charts_to_excel(writer, st_df, sheet_name="s_t_Values")
-
+        # ─── 7) (optional) Excel download with charts (built on click) ─────
         st.download_button(
             "📥 Download Triaxial + s–t (Excel, with charts)",
-            data=buffer.getvalue(),
+            data=partial(build_triaxial_excel, tri_df_with_st, st_df),
             file_name="triaxial_summary_s_t.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
+        # ─── 8) (optional) Interactive s–t plot ────────────────────────────
+        render_st_plot(tri_df_with_st)
+
     # ──────────────────────────────────────────────────────────────
     # New Section: Combine into Continuous Geological Intervals
     # ──────────────────────────────────────────────────────────────
@@ -314,22 +204,17 @@ if uploaded_files:
                         # Download buttons
                         col1, col2 = st.columns(2)
                         with col1:
-                            csv_buf = io.StringIO()
-                            result_df.to_csv(csv_buf, index=False)
                             st.download_button(
                                 "📥 Download CSV",
-                                csv_buf.getvalue(),
+                                result_df.to_csv(index=False),
                                 "continuous_intervals.csv",
                                 "text/csv"
                             )
 
                         with col2:
-                            excel_buf = io.BytesIO()
-                            with pd.ExcelWriter(excel_buf, engine='xlsxwriter') as writer:
-                                result_df.to_excel(writer, index=False, sheet_name="Intervals")
                             st.download_button(
                                 "📥 Download Excel",
-                                excel_buf.getvalue(),
+                                build_single_sheet_excel(result_df, "Intervals"),
                                 "continuous_intervals.xlsx",
                                 "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                             )
@@ -1,39 +1,79 @@
 from typing import Dict,Optional, List, Tuple
 import pandas as pd
 import csv
-import io
 import streamlit as st
 
+# AGS3 headings/groups written with a wildcard first letter, and their real names
+AGS_HEADING_FIXES = {
+    "?ETH": "WETH",
+    "?ETH_TOP": "WETH_TOP",
+    "?ETH_BASE": "WETH_BASE",
+    "?ETH_GRAD": "WETH_GRAD",
+    "?LEGD": "LEGD",
+    "?HORN": "HORN",
+}
+
+# Unit rows carry no data. (PROJ/ABBR header lines in old files need no
+# special case: real groups start with "**" or "GROUP".)
+UNIT_KEYWORDS = frozenset(("<UNITS>", "UNIT", "<UNIT>"))
+
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # PARSING ENGINE (v2.0)
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
-def _split_quoted_csv(line: str) -> List[str]:
+class _OneLine:
+    """Iterator that hands a csv.reader exactly one pending line."""
+    __slots__ = ("line",)
+
+    def __init__(self):
+        self.line = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line, self.line = self.line, None
+        if line is None:
+            raise StopIteration
+        return line
+
+
+def _quoted_csv_splitter():
     """
-    Parses a single CSV line using the standard csv library.
-    This handles quotes ("val", "val"), escaped quotes ("val""val"), 
+    Returns split(line) -> List[str], parsing one CSV line with the standard
+    csv library. This handles quotes ("val", "val"), escaped quotes ("val""val"),
     and empty fields (,,) correctly, unlike simple string splitting.
+    One reader is reused for every line of a file instead of building a
+    StringIO + reader per line; since it is only ever fed a single line, an
+    unclosed quote ends at the end of that line, as before. Not thread-safe:
+    make one per parse.
     """
-    if not line or not line.strip():
-        return []
-    try:
-        # skipinitialspace allows "Val", "Val" to be parsed correctly
-        reader = csv.reader(io.StringIO(line.strip()), strict=False, skipinitialspace=True)
-        return next(reader)
-    except Exception:
-        return []
+    feed = _OneLine()
+    # skipinitialspace allows "Val", "Val" to be parsed correctly
+    reader = csv.reader(feed, strict=False, skipinitialspace=True)
+
+    def split(line: str) -> List[str]:
+        if not line or not line.strip():
+            return []
+        feed.line = line.strip()
+        try:
+            return next(reader, [])
+        except Exception:
+            feed.line = None
+            return []
+
+    return split
+
+# Common primary keys for boreholes, in order of preference
+HOLE_ID_CANDIDATES = ("HOLE_ID", "HOLEID", "HOLE", "LOCA_ID", "LOCATION_ID")
+
 
 def find_hole_id_column(columns: List[str]) -> Optional[str]:
     """Identify HOLE_ID or common variants in a list of columns."""
     # Create a map of uppercase column names to original names
     uc_map = {str(c).upper(): c for c in columns}
 
-    # List of common primary keys for boreholes
-    candidates = [
-        "HOLE_ID", "HOLEID", "HOLE", "LOCA_ID", "LOCATION_ID"
-    ]
-
-    for cand in candidates:
+    for cand in HOLE_ID_CANDIDATES:
         if cand in uc_map:
             return uc_map[cand]
 
@@ -57,8 +97,15 @@ def analyze_ags_content(file_bytes: bytes) -> Dict[str, str]:
         "Contains **HOLE": "No"
     }
     try:
-        content = file_bytes.decode("latin-1", errors="ignore")
-        # Quick scan of first 50 lines usually suffices for detection
+        # Quick scan of first 50 lines usually suffices for detection,
+        # so only decode up to the 50th newline instead of the whole file
+        end = -1
+        for _ in range(50):
+            end = file_bytes.find(b"\n", end + 1)
+            if end == -1:
+                break
+        head = file_bytes if end == -1 else file_bytes[:end]
+        content = head.decode("latin-1", errors="ignore")
         lines = content.splitlines()[:50]
         for line in lines:
             s = line.strip()
@@ -79,13 +126,20 @@ def analyze_ags_content(file_bytes: bytes) -> Dict[str, str]:
         pass
     return results
 
-def parse_ags_file(file_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]:
+def parse_ags_file(
+    file_bytes: bytes,
+    file_name: str,
+    analysis: Optional[Dict[str, str]] = None,
+) -> Dict[str, pd.DataFrame]:
     """
     Main parser. Reads AGS3/4 files, handling continuation lines and 
     split headings robustly.
+    Pass the result of analyze_ags_content as `analysis` if the caller
+    already has it, to avoid scanning the file twice.
     """
     # 1. Detect Version
-    analysis = analyze_ags_content(file_bytes)
+    if analysis is None:
+        analysis = analyze_ags_content(file_bytes)
     is_ags3 = analysis.get("AGS3") == "Yes"
     is_ags4 = analysis.get("AGS4") == "Yes"
 
@@ -102,6 +156,7 @@ def parse_ags_file(file_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]
     data_started = False  # Flag: Have we moved from HEADINGS to DATA in this group?
     
     parse_errors = []
+    split_line = _quoted_csv_splitter()
 
     def ensure_group(name: str):
         group_data.setdefault(name, [])
@@ -157,12 +212,9 @@ def parse_ags_file(file_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]
             last_row[field] = f"{prev} | {val}" if prev else val
 
     # 4. Main Parsing Loop
-    for i, line in enumerate(raw_lines):
-        # Skip empty lines or purely whitespace
-        if not line.strip():
-            continue
-            
-        parts = _split_quoted_csv(line)
+    for line in raw_lines:
+        # Empty or whitespace-only lines split to [] and are skipped here
+        parts = split_line(line)
         if not parts:
             continue
 
@@ -182,12 +234,8 @@ def parse_ags_file(file_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]
             append_continuation(parts)
             continue
             
-        # --- B. Skip Metadata/Units ---
-        if keyword in ["<UNITS>", "UNIT", "<UNIT>", "PROJ", "ABBR"]: 
-            # Note: PROJ/ABBR here filters out old-style header garbage if present, 
-            # but real groups start with "**" or "GROUP".
-            pass 
-        if keyword in ["<UNITS>", "UNIT", "<UNIT>"]:
+        # --- B. Skip Units ---
+        if keyword in UNIT_KEYWORDS:
             continue
 
         # --- C. AGS4 Logic ---
@@ -259,15 +307,7 @@ def parse_ags_file(file_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]
         df = pd.DataFrame(rows)
         if not df.empty:
             # Normalize odd column headings early
-            rename_map = {
-                "?ETH": "WETH",
-                "?ETH_TOP": "WETH_TOP",
-                "?ETH_BASE": "WETH_BASE",
-                "?ETH_GRAD": "WETH_GRAD",
-                "?LEGD": "LEGD",
-                "?HORN": "HORN",
-            }
-            df = df.rename(columns=rename_map)
+            df = df.rename(columns=AGS_HEADING_FIXES)
 
             # Add source file column using the provided file name
             df["SOURCE_FILE"] = file_name
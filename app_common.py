@@ -0,0 +1,359 @@
+"""
+Pieces shared by the Streamlit front ends (MAINcode.py, parseronly.py).
+Keeping the cached steps in one module means every page hits the same
+st.cache_data entries instead of each script owning its own copy.
+"""
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import streamlit as st
+
+from agsparser import analyze_ags_content, parse_ags_file, find_hole_id_column
+from cleaners import (
+    combine_groups, deduplicate_frame, drop_singleton_rows, expand_rows,
+    coalesce_columns, to_numeric_safe, normalize_columns,
+)
+from triaxial import (
+    generate_triaxial_table, calculate_s_t_values, remove_duplicate_tests, match_depth_intervals,
+)
+from excel_util import build_all_groups_excel
+
+
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# Readers
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+# Columns the GIU table is used for (lithology mapping); everything else is
+# skipped at read time. Compared after upper-casing/stripping the header.
+GIU_COLUMNS = {"HOLE_ID", "LOCA_ID", "DEPTH_FROM", "DEPTH_TO", "START_DEPTH", "END_DEPTH", "LITH"}
+
+
+def is_giu_column(name) -> bool:
+    return str(name).upper().strip() in GIU_COLUMNS
+
+
+def read_csv_as_text(raw: bytes, usecols: Optional[Callable[[str], bool]] = None) -> pd.DataFrame:
+    """
+    Multi-threaded pyarrow CSV read with every column typed as string.
+    pd.read_csv(engine="pyarrow", dtype=str) infers types first and casts
+    afterwards, which turns hole IDs like '001' into '1'.
+    `usecols` (a header predicate) skips the other columns while reading.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pacsv
+    except ImportError:
+        return pd.read_csv(io.BytesIO(raw), dtype=str, usecols=usecols)
+
+    try:
+        # The streaming reader only parses the first block to get the header
+        names = pacsv.open_csv(io.BytesIO(raw)).schema.names
+        if usecols is not None:
+            names = [c for c in names if usecols(c)]
+        table = pacsv.read_csv(
+            io.BytesIO(raw),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=names,
+                column_types={c: pa.string() for c in names},
+                strings_can_be_null=True,
+            ),
+        )
+    except pa.ArrowInvalid:
+        return pd.read_csv(io.BytesIO(raw), dtype=str, usecols=usecols)
+    return table.to_pandas()
+
+
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# Cached pipeline steps (Streamlit reruns the script on every widget change)
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+# Hole IDs are cast to Arrow-backed strings, so the strip/upper calls and the
+# GIU prefix concatenation run as vectorised Arrow kernels, not per object
+HOLE_ID_DTYPE = "string[pyarrow]"
+
+# Opt-in: AGS_CACHE_PERSIST=1 also writes parsed uploads to Streamlit's disk
+# cache, so the same files are not re-parsed after an app restart. Off by
+# default because it keeps users' parsed data on the server: max_entries only
+# caps the in-memory layer, and disk copies stay until `streamlit cache clear`.
+PARSE_CACHE_PERSIST = "disk" if os.environ.get("AGS_CACHE_PERSIST") == "1" else None
+
+
+@st.cache_data(show_spinner=False, persist=PARSE_CACHE_PERSIST, max_entries=64)
+def parse_and_clean(raw: bytes, filename: str, giu_no: str) -> Tuple[Dict[str, str], Dict[str, pd.DataFrame]]:
+    """
+    Diagnose, parse and clean one uploaded AGS file.
+    Keyed on the file bytes, so reruns only re-parse files that changed.
+    """
+    # 1) Diagnostics
+    flags = analyze_ags_content(raw)
+
+    # 2) Parse into per-group DataFrames
+    raw_groups: Dict[str, pd.DataFrame] = parse_ags_file(raw, filename, analysis=flags)
+    cleaned_groups: Dict[str, pd.DataFrame] = {}
+
+    for group_name, df in raw_groups.items():
+        if df is None or df.empty:
+            continue
+
+        # Cleaning steps (same as before). parse_ags_file has already added
+        # SOURCE_FILE, and deduplicate_frame strips every text cell, so
+        # neither is redone below.
+        df = normalize_columns(df)
+        df = drop_singleton_rows(df)
+        df = deduplicate_frame(df)
+        coalesce_columns(df, ["DEPTH_FROM", "START_DEPTH"], "DEPTH_FROM")
+        coalesce_columns(df, ["DEPTH_TO", "END_DEPTH"], "DEPTH_TO")
+        to_numeric_safe(df, ["DEPTH_FROM", "DEPTH_TO"])
+
+        # ── IMPORTANT: Add GIU prefixing here ───────────────────────────────
+        df["GIU_NO"] = giu_no
+        hole_id_col = find_hole_id_column(df.columns)
+        if hole_id_col:
+            df[hole_id_col] = df[hole_id_col].astype(HOLE_ID_DTYPE)
+            df["GIU_HOLE_ID"] = giu_no + "_" + df[hole_id_col]
+
+        cleaned_groups[group_name] = df
+
+    return flags, cleaned_groups
+
+
+@st.cache_data(show_spinner=False, persist=PARSE_CACHE_PERSIST, max_entries=16)
+def load_giu(raw: bytes, name: str) -> pd.DataFrame:
+    """
+    Read and clean the GIU lithology table from its uploaded bytes.
+    """
+    # Fast readers first (pyarrow CSV, Rust calamine for xlsx/xls); fall back to
+    # the default engines if they are not installed or cannot read the file.
+    # Everything is read as text: expand_rows/deduplicate_frame work on strings anyway,
+    # so depths are converted to numbers exactly once, by to_numeric_safe below.
+    # Only the GIU_COLUMNS are read; other columns would just be expanded and cleaned.
+    buf = io.BytesIO(raw)
+    if name.lower().endswith(".csv"):
+        giu_df = read_csv_as_text(raw, usecols=is_giu_column)
+    else:
+        try:
+            giu_df = pd.read_excel(buf, engine="calamine", dtype=str, usecols=is_giu_column)
+        except (ImportError, ValueError):
+            buf.seek(0)
+            giu_df = pd.read_excel(buf, dtype=str, usecols=is_giu_column)
+
+    giu_df = normalize_columns(giu_df)
+
+    if "LOCA_ID" in giu_df.columns and "HOLE_ID" not in giu_df.columns:
+        giu_df = giu_df.rename(columns={"LOCA_ID": "HOLE_ID"})
+
+    giu_df = drop_singleton_rows(giu_df)
+    giu_df = expand_rows(giu_df)
+    giu_df = deduplicate_frame(giu_df)
+    coalesce_columns(giu_df, ["DEPTH_FROM" ,"START_DEPTH"], "DEPTH_FROM")
+    coalesce_columns(giu_df, ["DEPTH_TO" ,"END_DEPTH"],     "DEPTH_TO")
+    to_numeric_safe(giu_df, ["DEPTH_FROM" ,"DEPTH_TO"])
+    if "LITH" in giu_df.columns:
+        giu_df["LITH"] = giu_df["LITH"].astype("category")
+    return giu_df
+
+
+# The steps below take the merged frames as underscore (unhashed) arguments and
+# are keyed on `inputs_key` instead: the upload file_ids plus GIU numbering.
+# Hashing every combined group on each rerun costs about as much as the work.
+# file_ids are new for every upload (even of the same bytes), so these entries
+# are only ever reused by the current upload set: keep a few, and expire them.
+UPLOAD_KEYED_CACHE = {"max_entries": 8, "ttl": 60 * 60}
+
+@st.cache_data(show_spinner=False, **UPLOAD_KEYED_CACHE)
+def combine_uploads(
+    inputs_key: Tuple,
+    _all_group_dfs: List[Tuple[str, Dict[str, pd.DataFrame]]],
+) -> Dict[str, pd.DataFrame]:
+    """combine_groups, cached on the identity of the uploaded files."""
+    return combine_groups(_all_group_dfs)
+
+
+@st.cache_data(show_spinner=False, **UPLOAD_KEYED_CACHE)
+def build_triaxial_summary(
+    inputs_key: Tuple,
+    _combined_groups: Dict[str, pd.DataFrame],
+    _giu_df: Optional[pd.DataFrame],
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Triaxial table -> GIU lithology -> s, t -> de-duplicated summary.
+    Returns (tri_df_with_st, st_df); both empty if no triaxial data was found.
+    """
+    giu_df = _giu_df
+
+    # 1) Build raw triaxial summary
+    tri_df = generate_triaxial_table(_combined_groups)
+    if tri_df.empty:
+        return tri_df, tri_df
+
+    # ─── 2) Normalize IDs & depths ─────────────────────────────────────
+    # Prefer GIU_HOLE_ID if it exists (from prefixing), else HOLE_ID
+    id_col = 'GIU_HOLE_ID' if 'GIU_HOLE_ID' in tri_df.columns else 'HOLE_ID'
+
+    if id_col in tri_df.columns:
+        tri_df[id_col] = tri_df[id_col].astype(HOLE_ID_DTYPE).str.upper().str.strip()
+        tri_df['HOLE_ID'] = tri_df[id_col]  # Ensure consistent name for display
+    else:
+        st.warning(f"No hole ID column found (tried {id_col}, HOLE_ID). Using 'UNKNOWN'.")
+        tri_df['HOLE_ID'] = 'UNKNOWN'
+
+    # SPEC_DEPTH is already numeric: generate_triaxial_table converts it
+
+    # ─── 3) Map lithology from GIU into tri_df ─────────────────────────
+    # First GIU interval (in GIU order) whose HOLE_ID ends with the test's hole
+    # and whose depth range contains SPEC_DEPTH; one vectorised pass per hole
+    if giu_df is not None:
+        idx = match_depth_intervals(
+            tri_df["HOLE_ID"], tri_df["SPEC_DEPTH"],
+            giu_df["HOLE_ID"].str.upper(),  # already stripped by load_giu
+            giu_df["DEPTH_FROM"], giu_df["DEPTH_TO"],
+            suffix=True,
+        )
+        # -1 (no match) picks the trailing None
+        tri_df["LITH"] = np.append(giu_df["LITH"].to_numpy(dtype=object), None)[idx]
+    else:
+        tri_df["LITH"] = None
+
+    # ─── 4) Compute s & t ───────────────────────────────────────────────
+    st_df = calculate_s_t_values(tri_df)
+
+    # ─── 5) Attach s,t to the summary ───────────────────────────────────
+    # st_df is tri_df row for row (same index), so the columns are assigned by
+    # index instead of re-joined on HOLE_ID/SPEC_DEPTH/CELL/PWPF/DEVF: no hash
+    # join, no fan-out on repeated keys, no text-vs-number key mismatch.
+    st_cols = ["s", "t", "s_total", "s_effective", "s_source"]
+    tri_df_with_st = (
+        tri_df
+        .assign(**{c: st_df[c] for c in st_cols})
+        .pipe(remove_duplicate_tests)
+    )
+
+    # Low-cardinality keys as categoricals: smaller frame to cache, display and export
+    for c in ["HOLE_ID", "LITH", "TEST_TYPE", "SOURCE_FILE"]:
+        if c in tri_df_with_st.columns:
+            tri_df_with_st[c] = tri_df_with_st[c].astype("category")
+    return tri_df_with_st, st_df
+
+
+# Plot label for tests whose depth falls outside every GIU interval
+UNMAPPED_LITH = "Unmapped"
+
+ST_HOVER_COLUMNS = ["HOLE_ID", "SPEC_DEPTH", "CELL", "DEVF", "PWPF", "s_source"]
+
+
+def st_plot_frame(tri_df_with_st: pd.DataFrame) -> pd.DataFrame:
+    """
+    Only the columns the s–t plot reads, rows with both s and t, and missing
+    LITH as UNMAPPED_LITH so those tests are still plotted. Sliced before
+    build_st_figure so its cache hashes (and plotly serialises) just these.
+    """
+    keep = ["s", "t", "LITH", "SOURCE_FILE"] + ST_HOVER_COLUMNS
+    keep = [c for c in dict.fromkeys(keep) if c in tri_df_with_st.columns]
+    plot_df = tri_df_with_st.loc[:, keep].dropna(subset=["s", "t"])
+    plot_df["LITH"] = plot_df["LITH"].astype(object).fillna(UNMAPPED_LITH).astype("category")
+    return plot_df
+
+
+@st.cache_data(show_spinner=False)
+def build_st_figure(plot_df: pd.DataFrame, pick_lith: Tuple[str, ...]):
+    """
+    Interactive s–t scatter from st_plot_frame(), cached on that slim frame +
+    lithology selection so reruns with unchanged filters skip plotly's trace assembly.
+    """
+    hover_cols = [c for c in ST_HOVER_COLUMNS if c in plot_df.columns]
+    symbol_col = "SOURCE_FILE" if "SOURCE_FILE" in plot_df.columns else None
+
+    # Colour/symbol keys as categoricals for cheap trace grouping
+    if pick_lith:
+        plot_df = plot_df[plot_df["LITH"].isin(pick_lith)]
+    plot_df = plot_df.astype({c: "category" for c in ["LITH", symbol_col] if c})
+
+    fig = px.scatter(
+        plot_df,
+        x="s",
+        y="t",
+        color="LITH",
+        symbol=symbol_col,
+        hover_data=hover_cols,
+        labels={"s": "s (kPa)", "t": "t = q/2 (kPa)"},
+        title="s–t stress path",
+        render_mode="webgl",  # canvas instead of SVG for large point counts
+    )
+    # Fixed uirevision keeps the user's zoom/pan when the figure is re-sent
+    fig.update_layout(hovermode="closest", uirevision="st")
+    return fig
+
+
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# Shared UI blocks
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+# Row cap for the group tables shown in the tabs
+PREVIEW_ROWS = 2000
+
+
+def render_diagnostics(diagnostics: List[Tuple[str, Dict[str, str]]]):
+    """Expander with the per-file AGS version / key-group flags."""
+    with st.expander("File diagnostics (AGS type & key groups)", expanded=False):
+        # Column-wise construction: every file has the same flag keys
+        flag_keys = diagnostics[0][1].keys() if diagnostics else []
+        diag_df = pd.DataFrame({
+            "File": [n for n, _ in diagnostics],
+            **{k: [flags.get(k) for _, flags in diagnostics] for k in flag_keys},
+        })
+        st.dataframe(diag_df, width='stretch')
+
+
+def render_group_tabs(combined_groups: Dict[str, pd.DataFrame]):
+    """One tab per merged AGS group, each with its own Excel download."""
+    group_names = sorted(combined_groups)
+    tabs = st.tabs(group_names)
+    for tab, gname in zip(tabs, group_names):
+        with tab:
+            gdf = combined_groups[gname]
+            st.write(f"**{gname}** — {len(gdf)} rows")
+            # Every tab's table is sent to the browser on each rerun, so large
+            # groups show a preview unless asked; downloads always have all rows
+            if len(gdf) > PREVIEW_ROWS and not st.checkbox(
+                f"Show all {len(gdf)} rows", key=f"all_rows_{gname}"
+            ):
+                st.caption(f"Showing the first {PREVIEW_ROWS} rows.")
+                st.dataframe(gdf.head(PREVIEW_ROWS), width='stretch', height=350)
+            else:
+                st.dataframe(gdf, width='stretch', height=350)
+
+            # Per-group download (Excel): same heading/sheet fixes and
+            # row-streaming writer as the all-groups workbook. Passed as a
+            # callable, so the workbook is only built when the button is clicked
+            st.download_button(
+                label=f"Download {gname} (Excel)",
+                data=partial(build_all_groups_excel, {gname: gdf}),
+                file_name=f"{gname}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"dl_{gname}",
+            )
+
+
+@st.fragment
+def render_st_plot(tri_df_with_st: pd.DataFrame):
+    """
+    Optional interactive s–t plot. Runs as a fragment, so toggling it or
+    changing the lithology selection reruns only this block, not the page.
+    """
+    if st.checkbox("Show interactive s–t plot", value=False):
+        plot_df = st_plot_frame(tri_df_with_st)
+        lith_options = plot_df["LITH"].cat.remove_unused_categories().cat.categories.tolist()
+        pick_lith = st.multiselect(
+            "Lithologies to plot (empty = all):",
+            options=lith_options,
+            default=lith_options,
+        )
+        st.plotly_chart(
+            build_st_figure(plot_df, tuple(pick_lith)),
+            width='stretch',
+        )
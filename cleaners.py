@@ -11,21 +11,51 @@ def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
 def drop_singleton_rows(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
-    # Treat empty strings and whitespace as NaN
-    pd.set_option('future.no_silent_downcasting', True)  # Add this line once at the beginning of the script
-    clean = df.replace(r"^\s*$", np.nan, regex=True).infer_objects(copy=False)
-    nn = clean.notna().sum(axis=1)
+    # Count filled cells per row, treating empty strings and whitespace as NaN.
+    # Done column by column into one counter instead of building a regex-replaced
+    # copy of the whole frame just to call notna() on it.
+    nn = np.zeros(len(df), dtype=np.int64)
+    for _, s in df.items():
+        filled = s.notna().to_numpy()
+        if s.dtype == object or isinstance(s.dtype, pd.StringDtype):
+            try:
+                # non-string objects give NaN from .str and count as filled
+                blank = s.str.strip().eq("").to_numpy(dtype=bool, na_value=False)
+            except AttributeError:  # object column without any strings
+                blank = False
+            filled = filled & ~blank
+        nn += filled
     return df.loc[nn > 1].reset_index(drop=True)
 
 def deduplicate_cell(cell):
     if pd.isna(cell):
         return cell
-    parts = [p.strip() for p in str(cell).split(" | ")]
-    unique_parts = []
-    for p in parts:
-        if p and p not in unique_parts:
-            unique_parts.append(p)
-    return " | ".join(unique_parts)
+    # dict.fromkeys keeps first-seen order with O(1) membership checks
+    parts = dict.fromkeys(p.strip() for p in str(cell).split(" | "))
+    return " | ".join(p for p in parts if p)
+
+
+def deduplicate_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Column-wise replacement for df.map(deduplicate_cell).
+    Numeric columns are left alone; in text columns only cells containing
+    ' | ' go through deduplicate_cell, the rest are just stripped.
+    """
+    for col in df.select_dtypes(include=["object", "string"]).columns:
+        s = df[col]
+        notna = s.notna()
+        if not notna.any():
+            continue
+        text = s[notna].astype(str)
+        out = text.str.strip()
+        multi = text.str.contains(" | ", regex=False)
+        if multi.any():
+            # AGS groups repeat the same merged values down a column, so
+            # de-duplicate each distinct string once and map the results back
+            merged = text[multi]
+            out[multi] = merged.map({v: deduplicate_cell(v) for v in merged.unique()})
+        df[col] = out.reindex(s.index).where(notna, s)
+    return df
 
 
 def expand_rows(df: pd.DataFrame) -> pd.DataFrame:
@@ -33,34 +63,47 @@ def expand_rows(df: pd.DataFrame) -> pd.DataFrame:
     Expand rows where any cell contains ' | ' separated values,
     but skip expansion if all split values across columns are identical.
     """
-    expanded_rows = []
-
-    for _, row in df.iterrows():
-        split_values = {
-            col: (str(row[col]).split(" | ") if pd.notna(row[col]) else [""])
-            for col in df.columns
-        }
-
-        # Check if all columns have the same repeated value
-        all_same = all(
-            len(set(values)) == 1 for values in split_values.values()
-        )
-
-        if all_same and all(len(values) > 1 for values in split_values.values()):
-            # If all values are the same and repeated, keep as single row
-            new_row = {col: split_values[col][0] for col in df.columns}
-            expanded_rows.append(new_row)
+    if df.empty:
+        return pd.DataFrame(index=range(len(df)), columns=df.columns)
+
+    # Work column by column instead of iterrows(): every cell becomes its text
+    # ("" for missing) and only columns that contain ' | ' are actually split.
+    n = len(df)
+    texts: List[np.ndarray] = []
+    parts: Dict[int, pd.Series] = {}
+    lens = np.ones((n, df.shape[1]), dtype=np.int64)
+    for j, (_, s) in enumerate(df.items()):
+        text = s.astype(str).where(s.notna(), "")
+        texts.append(text.to_numpy(dtype=object))
+        if text.str.contains(" | ", regex=False).any():
+            parts[j] = text.str.split(" | ", regex=False)
+            lens[:, j] = parts[j].str.len().to_numpy()
+
+    # A row whose every column repeats one value (and splits into more than
+    # one part) is kept as a single row; any other row becomes max-parts rows
+    collapse = lens.min(axis=1) > 1
+    for i in np.flatnonzero(collapse):
+        collapse[i] = all(len(set(p.iat[i])) == 1 for p in parts.values())
+    reps = np.where(collapse, 1, lens.max(axis=1))
+
+    # Output row -> (source row, part number); missing parts are ""
+    src = np.repeat(np.arange(n), reps)
+    k = np.arange(len(src)) - np.repeat(np.cumsum(reps) - reps, reps)
+    out: Dict[str, np.ndarray] = {}
+    for j, col in enumerate(df.columns):
+        if j in parts:
+            flat = np.array([v for p in parts[j] for v in p], dtype=object)
+            starts = np.cumsum(lens[:, j]) - lens[:, j]
+            take = k < lens[src, j]
+            values = np.full(len(src), "", dtype=object)
+            values[take] = flat[starts[src[take]] + k[take]]
         else:
-            # Expand into multiple rows
-            max_len = max(len(v) for v in split_values.values()) if split_values else 1
-            for i in range(max_len):
-                new_row = {
-                    col: (split_values[col][i] if i < len(split_values[col]) else "")
-                    for col in df.columns
-                }
-                expanded_rows.append(new_row)
+            values = texts[j][src]
+            values[k > 0] = ""
+        out[col] = values
+
+    return pd.DataFrame(out)
 
-    return pd.DataFrame(expanded_rows) 
 
 def combine_groups(all_group_dfs: List[Tuple[str, Dict[str, pd.DataFrame]]]) -> Dict[str, pd.DataFrame]:
     """
@@ -68,14 +111,32 @@ def combine_groups(all_group_dfs: List[Tuple[str, Dict[str, pd.DataFrame]]]) ->
     Returns {group_name: combined_df}
     """
     combined: Dict[str, List[pd.DataFrame]] = {}
+    sources: Dict[str, List[Tuple[str, int]]] = {}
     for fname, gdict in all_group_dfs:
         for gname, df in gdict.items():
             if df is None or df.empty:
                 continue
-            temp = df.copy()
-            temp["SOURCE_FILE"] = fname
-            combined.setdefault(gname, []).append(temp)
-    return {g: drop_singleton_rows(pd.concat(dfs, ignore_index=True)) for g, dfs in combined.items()}
+            combined.setdefault(gname, []).append(df)
+            sources.setdefault(gname, []).append((fname, len(df)))
+
+    # One concat per group; SOURCE_FILE is filled in afterwards instead of
+    # copying every per-file frame just to stamp its name on it.
+    out: Dict[str, pd.DataFrame] = {}
+    for g, dfs in combined.items():
+        # A group seen in only one file needs no concat at all; a shallow copy
+        # is enough to add SOURCE_FILE without touching the caller's frame.
+        if len(dfs) == 1:
+            merged = dfs[0].copy(deep=False)
+        else:
+            merged = pd.concat(dfs, ignore_index=True, sort=False)
+        fnames, lengths = zip(*sources[g])
+        # SOURCE_FILE as a categorical built straight from per-file codes:
+        # one small int per row instead of a repeated file-name string
+        categories = list(dict.fromkeys(fnames))
+        codes = np.repeat([categories.index(f) for f in fnames], lengths)
+        merged["SOURCE_FILE"] = pd.Categorical.from_codes(codes, categories=categories)
+        out[g] = drop_singleton_rows(merged)
+    return out
     
 def coalesce_columns(df: pd.DataFrame, candidates: List[str], new_name: str):
     """
@@ -83,7 +144,8 @@ def coalesce_columns(df: pd.DataFrame, candidates: List[str], new_name: str):
     """
     for c in candidates:
         if c in df.columns:
-            df[new_name] = df[c]
+            if c != new_name:
+                df[new_name] = df[c]
             return
     # ensure column exists
     if new_name not in df.columns:
@@ -2,6 +2,8 @@ from typing import Dict
 import pandas as pd 
 import io
 import re
+import xlsxwriter
+from agsparser import AGS_HEADING_FIXES
 from cleaners import drop_singleton_rows
 
 
@@ -11,57 +13,120 @@ from cleaners import drop_singleton_rows
 
 
 
+# Streaming workbook options: rows are flushed to disk as they are written and
+# plain strings are stored as-is (no URL / formula / number sniffing per cell).
+XLSX_STREAM_OPTIONS = {
+    "constant_memory": True,
+    "strings_to_urls": False,
+    "strings_to_formulas": False,
+    "strings_to_numbers": False,
+    # ±inf (e.g. "1e400" through to_numeric) becomes an Excel error cell instead of raising
+    "nan_inf_to_errors": True,
+}
+
+
+def unique_sheet_name(name: str, taken: set) -> str:
+    """
+    31-character sheet name that does not clash (case-insensitively, as in
+    Excel) with a name in taken; clashes get a _2, _3, ... suffix.
+    The chosen name is added to taken.
+    """
+    base = name[:31]
+    candidate, n = base, 1
+    while candidate.lower() in taken:
+        n += 1
+        suffix = f"_{n}"
+        candidate = base[:31 - len(suffix)] + suffix
+    taken.add(candidate.lower())
+    return candidate
+
+
+def write_sheet_rows(workbook: xlsxwriter.Workbook, sheet_name: str, df: pd.DataFrame):
+    """
+    Write df (header + data) to a new worksheet one row at a time.
+    DataFrame.to_excel writes column by column, which constant_memory cannot handle.
+    """
+    ws = workbook.add_worksheet(sheet_name)
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    values = df.astype(object).where(df.notna(), None)
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, row)
+    return ws
+
+
+def build_single_sheet_excel(df: pd.DataFrame, sheet_name: str) -> bytes:
+    """
+    One-sheet workbook for a plain table, written with the streaming row writer.
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, XLSX_STREAM_OPTIONS)
+    write_sheet_rows(workbook, sheet_name, df)
+    workbook.close()
+    return buffer.getvalue()
+
+
 def build_all_groups_excel(groups: Dict[str, pd.DataFrame]) -> bytes:
     """
     Create an Excel workbook where each group is one sheet.
     Sanitizes sheet names to prevent Excel errors.
     """
-    
-    rename_map = {
-        "?ETH": "WETH",
-        "?ETH_TOP": "WETH_TOP",
-        "?ETH_BASE": "WETH_BASE",
-        "?ETH_GRAD": "WETH_GRAD",
-        "?LEGD": "LEGD",
-        "?HORN": "HORN",
-    }
     buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as xw:
-        for gname, gdf in sorted(groups.items()):
-            if gdf is None or gdf.empty:
-                continue
-        
-            # apply column heading fixes
-            gdf = gdf.rename(columns=rename_map)
-        
-            # apply sheet name fixes
-            gname = rename_map.get(gname, gname)
-        
-            # sanitize + truncate as before
-            safe_name = re.sub(r"[\[\]:*?/\\]", "_", gname)
-            sheet_name = safe_name[:31]
-            
-            # Clean rows (no singleton)
-            out = drop_singleton_rows(gdf)
-            out.to_excel(xw, index=False, sheet_name=sheet_name)
+    workbook = xlsxwriter.Workbook(buffer, XLSX_STREAM_OPTIONS)
+    taken: set = set()
+    for gname, gdf in sorted(groups.items()):
+        if gdf is None or gdf.empty:
+            continue
+
+        # apply column heading fixes
+        gdf = gdf.rename(columns=AGS_HEADING_FIXES)
+
+        # apply sheet name fixes
+        gname = AGS_HEADING_FIXES.get(gname, gname)
+
+        # sanitize + truncate as before
+        # (AGS3 "?ETH" and AGS4 "WETH" both become WETH: the second gets WETH_2)
+        safe_name = re.sub(r"[\[\]:*?/\\]", "_", gname)
+        sheet_name = unique_sheet_name(safe_name, taken)
+
+        # Clean rows (no singleton)
+        out = drop_singleton_rows(gdf)
+        write_sheet_rows(workbook, sheet_name, out)
+    workbook.close()
     return buffer.getvalue()
 
 
 
+def build_triaxial_excel(tri_df: pd.DataFrame, st_df: pd.DataFrame, summary_sheet: str = "Triaxial_Summary") -> bytes:
+    """
+    Triaxial summary + s–t values workbook with the s–t charts sheet,
+    written with the streaming row writer.
+    """
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, XLSX_STREAM_OPTIONS)
+    write_sheet_rows(workbook, summary_sheet, tri_df)
+    write_sheet_rows(workbook, "s_t_Values", st_df)
+    add_st_charts(workbook, st_df, "s_t_Values")
+    workbook.close()
+    return buffer.getvalue()
+
+
 def add_st_charts_to_excel(writer: pd.ExcelWriter, st_df: pd.DataFrame, sheet_name: str = "s_t_Values"):
     """
     Adds two scatter charts to a new sheet "Charts" based on the table written to sheet_name.
     Assumes st_df has been written to writer with sheet_name already.
     """
-    if st_df is None or st_df.empty:
+    # must have the values sheet already written
+    if sheet_name not in writer.sheets:
         return
+    add_st_charts(writer.book, st_df, sheet_name, charts_ws=writer.sheets.get("Charts"))
 
-    # workbook / sheets from the ExcelWriter (xlsxwriter)
-    workbook = writer.book
-    sheets = writer.sheets
 
-    # must have the values sheet already written
-    if sheet_name not in sheets:
+def add_st_charts(workbook, st_df: pd.DataFrame, sheet_name: str = "s_t_Values", charts_ws=None):
+    """
+    Adds the s′–t / s–t scatter charts to a "Charts" sheet (or charts_ws) of an
+    xlsxwriter workbook, reading from the st_df table written to sheet_name.
+    """
+    if st_df is None or st_df.empty:
         return
 
     # Row/col counts in the written sheet
@@ -76,18 +141,29 @@ def add_st_charts_to_excel(writer: pd.ExcelWriter, st_df: pd.DataFrame, sheet_na
     if "t" not in idx or ("s_effective" not in idx and "s_total" not in idx):
         return
 
+    # Only build a chart if it has at least 2 points to plot; chart objects are
+    # heavy to write and a 0/1-point scatter says nothing
+    def n_points(xcol: str, ycol: str) -> int:
+        if xcol not in idx or ycol not in idx:
+            return 0
+        return int((st_df[xcol].notna() & st_df[ycol].notna()).sum())
+
+    charts = [
+        spec for spec in [
+            ("s′–t (Effective stress)", "s_effective", "t", "B2"),   # s'–t (effective)
+            ("s–t (Total stress)", "s_total", "t", "B25"),           # s–t (total)
+        ]
+        if n_points(spec[1], spec[2]) >= 2
+    ]
+    if not charts:
+        return
+
     # Data rows in the sheet: header is row 0, data starts at row 1 and ends at row 1 + nrows - 1
     r0 = 1
     r1 = r0 + nrows - 1
 
-    # Create Charts worksheet (avoid name clash)
-    charts_name = "Charts"
-    # if Charts exists, remove or use new name
-    if charts_name in sheets:
-        ws_charts = sheets[charts_name]
-    else:
-        ws_charts = workbook.add_worksheet(charts_name)
-        # Not adding to writer.sheets mapping here; it's OK for charts insertion
+    # Create Charts worksheet unless the caller already has one
+    ws_charts = charts_ws if charts_ws is not None else workbook.add_worksheet("Charts")
 
     def add_scatter(title: str, xcol: str, ycol: str, anchor: str):
         if xcol not in idx or ycol not in idx:
@@ -111,44 +187,5 @@ def add_st_charts_to_excel(writer: pd.ExcelWriter, st_df: pd.DataFrame, sheet_na
         chart.set_size({'width': 640, 'height': 420})
         ws_charts.insert_chart(anchor, chart)
 
-    # s'–t (effective)
-    add_scatter("s′–t (Effective stress)", "s_effective", "t", "B2")
-    # s–t (total)
-    add_scatter("s–t (Total stress)", "s_total", "t", "B25")
-    
-def remove_duplicate_tests(df: pd.DataFrame) -> pd.DataFrame:
- 
-    if df.empty:
-        return df
-    
-    # Define key columns that should be unique for each test
-    key_cols = [
-        'HOLE_ID', 'SPEC_DEPTH', 'CELL', 'DEVF', 'PWPF', 
-        'TEST_TYPE', 'SOURCE_FILE'
-    ]
-    
-    # Use only columns that actually exist in the DataFrame
-    available_cols = [col for col in key_cols if col in df.columns]
-    
-    # If we have at least 3 identifying columns, use them for deduplication
-    if len(available_cols) >= 3:
-        # Create a copy of the relevant columns
-        temp_df = df[available_cols].copy()
-        
-        # Convert float columns to rounded strings for consistent comparison
-        for col in temp_df.columns:
-            if pd.api.types.is_float_dtype(temp_df[col]):
-                # Round floats to 2 decimal places and convert to string
-                temp_df[col] = temp_df[col].apply(lambda x: f"{x:.2f}" if not pd.isna(x) else "")
-            else:
-                # Convert non-float columns to string
-                temp_df[col] = temp_df[col].astype(str)
-        
-        # Create a combined string representation for each row
-        temp_df['combined'] = temp_df.apply(lambda row: '|'.join(row.values), axis=1)
-        
-        # Identify duplicates while keeping the first occurrence
-        mask = ~temp_df.duplicated(subset=['combined'], keep='first')
-        df = df[mask].reset_index(drop=True)
-    
-    return df
+    for title, xcol, ycol, anchor in charts:
+        add_scatter(title, xcol, ycol, anchor)
@@ -5,6 +5,8 @@ import pandas as pd
 import numpy as np
 from typing import List, Optional, Dict
 
+from cleaners import coalesce_columns, to_numeric_safe
+
 
 def build_continuous_intervals(
     df: pd.DataFrame,
@@ -81,9 +83,17 @@ def map_group_to_intervals(
         # Legacy-style: per-hole loop with .between()
         result = intervals.copy()
         result[value_col] = np.nan
-        for hole in result[hole_col].unique():
-            hole_int = result[result[hole_col] == hole]
-            hole_src = source_df[source_df[hole_col] == hole]
+        # Text values (most AGS fields) cannot be set into a float NaN column
+        if not pd.api.types.is_numeric_dtype(source_df[value_col]):
+            result[value_col] = result[value_col].astype(object)
+        # Split the source by hole once instead of re-filtering it per hole
+        src_by_hole = dict(list(
+            source_df[required].groupby(hole_col, sort=False)
+        ))
+        for hole, hole_int in result.groupby(hole_col, sort=False):
+            hole_src = src_by_hole.get(hole)
+            if hole_src is None:
+                continue
             for _, src_row in hole_src.iterrows():
                 mask = (
                     (hole_int['DEPTH_FROM'] >= src_row[source_from]) &
@@ -1,18 +1,86 @@
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # Imports
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+import numpy as np
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 from typing import List, Tuple, Dict
 import io
-import plotly.express as px
 import re
-import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 # External modules
-from agsparser import analyze_ags_content, _split_quoted_csv, parse_ags_file, find_hole_id_column
-from cleaners import deduplicate_cell, drop_singleton_rows, expand_rows, combine_groups, coalesce_columns, to_numeric_safe, normalize_columns
-from triaxial import generate_triaxial_table, generate_triaxial_with_lithology, calculate_s_t_values, remove_duplicate_tests
-from excel_util import add_st_charts_to_excel, build_all_groups_excel, remove_duplicate_tests
+from agsparser import analyze_ags_content, parse_ags_file, find_hole_id_column
+from cleaners import to_numeric_safe, normalize_columns
+from triaxial import generate_triaxial_table, calculate_s_t_values
+from excel_util import (
+    XLSX_STREAM_OPTIONS, build_all_groups_excel, build_triaxial_excel, unique_sheet_name, write_sheet_rows,
+)
+from app_common import HOLE_ID_DTYPE, UPLOAD_KEYED_CACHE, combine_uploads, render_diagnostics, render_group_tabs
+
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# Helpers
+# ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+def filter_group(df: pd.DataFrame, filters: Dict[str, list], columns) -> pd.DataFrame:
+    """
+    Apply all row filters as one combined isin() mask, then slice rows and
+    selected columns together instead of re-filtering the frame per column.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for column, allowed_values in filters.items():
+        if allowed_values and column in df.columns:
+            mask &= df[column].isin(allowed_values).to_numpy()
+    return df.loc[mask, [c for c in columns if c in df.columns]].copy()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def parse_with_prefix(file_bytes: bytes, file_name: str) -> Tuple[Dict[str, str], Dict[str, pd.DataFrame]]:
+    """
+    Diagnose and parse one AGS file, prefixing HOLE_ID with a short tag taken
+    from the file name. Cached on the file bytes, so widget reruns skip it.
+    """
+    # Extract safe file prefix
+    file_prefix = re.sub(r'[^A-Z0-9]', '', file_name.split('.')[0].upper())[:5]
+
+    # 1) Diagnostics
+    flags = analyze_ags_content(file_bytes)
+
+    # 2) Parse into per-group DataFrames
+    raw_groups: Dict[str, pd.DataFrame] = parse_ags_file(file_bytes, file_name, analysis=flags)
+    cleaned_groups: Dict[str, pd.DataFrame] = {}
+    for group_name, df in raw_groups.items():
+        # skip empty groups
+        if df is None or df.empty:
+            continue
+        # Find and prefix HOLE_ID
+        hole_id_col = find_hole_id_column(df.columns)
+        if hole_id_col:
+            # Ensure HOLE_ID is a string and prefix it
+            df[hole_id_col] = df[hole_id_col].astype(HOLE_ID_DTYPE).str.strip()
+            df[hole_id_col] = file_prefix + "_" + df[hole_id_col]
+        # 3) Normalize column names
+        df = normalize_columns(df)
+        # 7) depth columns
+        to_numeric_safe(df, ["DEPTH_FROM", "DEPTH_TO"])
+        # store cleaned group
+        cleaned_groups[group_name] = df
+    return flags, cleaned_groups
+
+
+@st.cache_data(show_spinner=False, **UPLOAD_KEYED_CACHE)
+def triaxial_with_st(inputs_key: Tuple, _combined_groups: Dict[str, pd.DataFrame]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Triaxial table and its s, t values (no GIU lithology on this page).
+    Cached on the upload ids, like combine_uploads, so reruns skip both.
+    """
+    tri_df = generate_triaxial_table(_combined_groups)
+    if tri_df.empty:
+        return tri_df, pd.DataFrame()
+    # ─── 2) Normalize IDs & depths ─────────────────────────────────────
+    # (SPEC_DEPTH is already numeric: generate_triaxial_table converts it)
+    tri_df["HOLE_ID"] = tri_df["HOLE_ID"].astype(HOLE_ID_DTYPE).str.upper().str.strip()
+    return tri_df, calculate_s_t_values(tri_df)
 
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 # Page Setup
@@ -36,60 +104,46 @@ uploaded_files = st.file_uploader(
 # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 if uploaded_files:
     all_group_dfs: List[Tuple[str, Dict[str, pd.DataFrame]]] = []
-    diagnostics: List[Tuple[str, Dict[str, bool]]] = []
+    diagnostics: List[Tuple[str, Dict[str, str]]] = []
     failed_files = []
     
     progress_bar = st.progress(0)
-    for i, f in enumerate(uploaded_files):
-        try:
-            file_bytes = f.getvalue()
-            # Extract safe file prefix
-            file_prefix = re.sub(r'[^A-Z0-9]', '', f.name.split('.')[0].upper())[:5]
-            
-            # 1) Diagnostics
-            flags = analyze_ags_content(file_bytes)
-            diagnostics.append((f.name, flags))
-            
-            # 2) Parse into per-group DataFrames
-            raw_groups: Dict[str, pd.DataFrame] = parse_ags_file(file_bytes, f.name)
-            cleaned_groups: Dict[str, pd.DataFrame] = {}
-            for group_name, df in raw_groups.items():
-                # skip empty groups
-                if df is None or df.empty:
-                    continue
-                # Add SOURCE_FILE column
-                df["SOURCE_FILE"] = f.name
-                # Find and prefix HOLE_ID
-                hole_id_col = find_hole_id_column(df.columns)
-                if hole_id_col:
-                    # Ensure HOLE_ID is a string and prefix it
-                    df[hole_id_col] = df[hole_id_col].astype(str).str.strip()
-                    df[hole_id_col] = file_prefix + "_" + df[hole_id_col]
-                # 3) Normalize column names
-                df = normalize_columns(df)
-                # 7) depth columns
-                to_numeric_safe(df, ["DEPTH_FROM", "DEPTH_TO"])
-                # store cleaned group
-                cleaned_groups[group_name] = df
-            # collect this file’s cleaned groups
-            all_group_dfs.append((f.name, cleaned_groups))
-        except Exception as e:
-            failed_files.append((f.name, str(e)))
-        progress_bar.progress((i + 1) / len(uploaded_files))
+    # Files are parsed on a small thread pool (workers get the script context so
+    # st.cache_data works there); results are collected in upload order.
+    with ThreadPoolExecutor(
+        max_workers=min(8, len(uploaded_files)),
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as pool:
+        futures = [(f.name, pool.submit(parse_with_prefix, f.getvalue(), f.name)) for f in uploaded_files]
+        for i, (fname, future) in enumerate(futures):
+            try:
+                flags, cleaned_groups = future.result()
+                diagnostics.append((fname, flags))
+                # collect this file’s cleaned groups
+                all_group_dfs.append((fname, cleaned_groups))
+            except Exception as e:
+                failed_files.append((fname, str(e)))
+            progress_bar.progress((i + 1) / len(uploaded_files))
     
     if failed_files:
         st.error("Some files failed to process:")
         st.dataframe(pd.DataFrame(failed_files, columns=["File", "Error"]))
     
-    # 9) Combine across files
-    combined_groups = combine_groups(all_group_dfs)
+    # 9) Combine across files (cached on the upload ids)
+    uploads_key = tuple(f.file_id for f in uploaded_files)
+    combined_groups = combine_uploads(uploads_key, all_group_dfs)
+
+    # Triaxial summary + s, t: computed once here and shared by the sidebar
+    # export and the Triaxial section below
+    tri_df, st_df = pd.DataFrame(), pd.DataFrame()
+    if "TRIX" in combined_groups or "TRIG" in combined_groups:
+        tri_df, st_df = triaxial_with_st(uploads_key, combined_groups)
     
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     # Step 4: Show quick diagnostics results
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-    with st.expander("File diagnostics (AGS type & key groups)", expanded=False):
-        diag_df = pd.DataFrame([{"File": n, **flags} for (n, flags) in diagnostics])
-        st.dataframe(diag_df, width='stretch')
+    render_diagnostics(diagnostics)
     
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     # Step 5: Sidebar: downloads and plotting options
@@ -112,21 +166,10 @@ if uploaded_files:
         with col2:
             if "TRIX" in combined_groups or "TRIG" in combined_groups:
                 if st.button("Triaxial + s-t charts"):
-                    tri_df = generate_triaxial_table(combined_groups)
                     if not tri_df.empty:
-                        tri_df["HOLE_ID"] = tri_df["HOLE_ID"].astype(str).str.upper().str.strip()
-                        tri_df["SPEC_DEPTH"] = pd.to_numeric(tri_df["SPEC_DEPTH"], errors="coerce")
-                        st_df = calculate_s_t_values(tri_df)
-                        
-                        buf = io.BytesIO()
-                        with pd.ExcelWriter(buf, engine="xlsxwriter") as w:
-                            tri_df.to_excel(w, "Summary", index=False)
-                            st_df.to_excel(w, "s_t_Values", index=False)
-                            add_st_charts_to_excel(w, st_df, "s_t_Values")
-                        buf.seek(0)
                         st.download_button(
                             "📥 Triaxial (Excel, with charts)",
-                            data=buf,
+                            data=build_triaxial_excel(tri_df, st_df, summary_sheet="Summary"),
                             file_name="triaxial_summary_s_t.xlsx",
                             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                             key="dl_tri"
@@ -193,10 +236,17 @@ if uploaded_files:
                     for col in group_column_selections[group_name]:
                         if col not in df.columns:
                             continue
-                        vals = sorted(df[col].dropna().unique())
+                        col_vals = df[col].dropna()
+                        if isinstance(col_vals.dtype, pd.CategoricalDtype):
+                            # categories are already unique and sorted
+                            vals = col_vals.cat.remove_unused_categories().cat.categories.tolist()
+                        else:
+                            vals = pd.unique(col_vals)
                         if len(vals) > 30:
                             st.caption(f"{col} — too many unique values ({len(vals)})")
                             continue
+                        # only sort once we know the list is short enough to show
+                        vals = sorted(vals)
                         selected = st.multiselect(f"{col}", vals, key=f"flt_{group_name}_{col}")
                         if selected:
                             row_filters[group_name][col] = selected
@@ -207,23 +257,21 @@ if uploaded_files:
                 
                 custom_buffer = io.BytesIO()
                 try:
-                    with pd.ExcelWriter(custom_buffer, engine="xlsxwriter") as writer:
+                    # Row-streaming xlsxwriter workbook (constant_memory), as for the other exports
+                    with xlsxwriter.Workbook(custom_buffer, XLSX_STREAM_OPTIONS) as workbook:
                         if concat_option:
                             # Concatenate or merge data across groups
                             concatenated_df = pd.DataFrame()
                             group_dfs = []
                             for group_name in selected_groups:
-                                group_df = combined_groups[group_name].copy()
-                                
-                                # Filter rows based on row_filters
-                                if enable_row_filters and group_name in row_filters:
-                                    for column, allowed_values in row_filters[group_name].items():
-                                        if allowed_values and column in group_df.columns:
-                                            group_df = group_df[group_df[column].isin(allowed_values)]
+                                group_df = combined_groups[group_name]
                                 
-                                # Select columns
-                                valid_columns = group_column_selections.get(group_name, group_df.columns)
-                                group_df = group_df[[c for c in valid_columns if c in group_df.columns]]
+                                # Filter rows based on row_filters and select columns in one pass
+                                group_df = filter_group(
+                                    group_df,
+                                    row_filters.get(group_name, {}) if enable_row_filters else {},
+                                    group_column_selections.get(group_name, group_df.columns),
+                                )
                                 
                                 # Handle point depths for merge
                                 if merge_on_keys:
@@ -251,28 +299,26 @@ if uploaded_files:
                             
                             # Save to Excel
                             if not concatenated_df.empty:
-                                concatenated_df.to_excel(writer, index=False, sheet_name="Concatenated_Groups")
+                                write_sheet_rows(workbook, "Concatenated_Groups", concatenated_df)
                             else:
-                                pd.DataFrame({"Note": ["No data after filtering"]}).to_excel(writer, index=False, sheet_name="Empty")
+                                write_sheet_rows(workbook, "Empty", pd.DataFrame({"Note": ["No data after filtering"]}))
                         else:
                             # Separate sheets for each group
+                            taken_sheets: set = set()
                             for group_name in selected_groups:
-                                group_df = combined_groups[group_name].copy()
-                                
-                                # Filter rows
-                                if enable_row_filters and group_name in row_filters:
-                                    for column, allowed_values in row_filters[group_name].items():
-                                        if allowed_values and column in group_df.columns:
-                                            group_df = group_df[group_df[column].isin(allowed_values)]
+                                group_df = combined_groups[group_name]
                                 
-                                # Select columns
-                                valid_columns = group_column_selections.get(group_name, group_df.columns)
-                                group_df = group_df[[c for c in valid_columns if c in group_df.columns]]
+                                # Filter rows and select columns in one pass
+                                group_df = filter_group(
+                                    group_df,
+                                    row_filters.get(group_name, {}) if enable_row_filters else {},
+                                    group_column_selections.get(group_name, group_df.columns),
+                                )
                                 
                                 # Save individual sheet
-                                safe_sheet = re.sub(r'[\[\]*?:/\\]', '_', group_name)[:31]
                                 if not group_df.empty:
-                                    group_df.to_excel(writer, index=False, sheet_name=safe_sheet)
+                                    safe_sheet = unique_sheet_name(re.sub(r'[\[\]*?:/\\]', '_', group_name), taken_sheets)
+                                    write_sheet_rows(workbook, safe_sheet, group_df)
                     
                     custom_buffer.seek(0)
                     st.download_button(
@@ -293,39 +339,7 @@ if uploaded_files:
     # ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     st.subheader("📋 AGS Groups (merged across all uploaded files)")
     
-    rename_map = {
-        "?ETH": "WETH",
-        "?ETH_TOP": "WETH_TOP",
-        "?ETH_BASE": "WETH_BASE",
-        "?ETH_GRAD": "WETH_GRAD",
-        "?LEGD": "LEGD",
-        "?HORN": "HORN",
-    }
-    
-    tabs = st.tabs(sorted(combined_groups.keys()))
-    for tab, gname in zip(tabs, sorted(combined_groups.keys())):
-        with tab:
-            gdf = combined_groups[gname]
-            st.write(f"**{gname}** — {len(gdf)} rows")
-            st.dataframe(gdf, width='stretch', height=350)
-            
-            # Per-group download (Excel)
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-                # apply column heading fixes
-                gdf_out = drop_singleton_rows(gdf).rename(columns=rename_map)
-                # apply sheet name fixes
-                safe_sheet = re.sub(r'[\[\]*?:/\\]', '_', rename_map.get(gname, gname))[:31]
-                gdf_out.to_excel(writer, index=False, sheet_name=safe_sheet)
-            buffer.seek(0)
-            
-            st.download_button(
-                label=f"Download {gname} (Excel)",
-                data=buffer,
-                file_name=f"{gname}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key=f"dl_{gname}",
-            )
+    render_group_tabs(combined_groups)
     
     st.divider()
     
@@ -335,16 +349,9 @@ if uploaded_files:
     if "TRIX" in combined_groups or "TRIG" in combined_groups:
         with st.container():
             st.header("Triaxial Summary & s–t Plots")
-            tri_df = generate_triaxial_table(combined_groups)
             if tri_df.empty:
                 st.info("No triaxial data (TRIX/TRET + TRIG/TREG) detected in the uploaded files.")
             else:
-                # ─── 2) Normalize IDs & depths ─────────────────────────────────────
-                tri_df["HOLE_ID"] = tri_df["HOLE_ID"].astype(str).str.upper().str.strip()
-                tri_df["SPEC_DEPTH"] = pd.to_numeric(tri_df["SPEC_DEPTH"], errors="coerce")
-                
-                st_df = calculate_s_t_values(tri_df)
-                
                 # ─── 6) Display summary ─────────────────────────────────────────────
                 st.write(f"**Triaxial summary (with s, t & lithology)** — {len(tri_df)} rows")
                 st.dataframe(tri_df, width='stretch', height=350)
@@ -1,4 +1,4 @@
-from typing import Dict, Tuple, Optional
+from typing import Dict, Tuple
 import numpy as np
 import pandas as pd
 
@@ -16,13 +16,14 @@ def generate_triaxial_table(groups: Dict[str, pd.DataFrame]) -> pd.DataFrame:
     - TRIX (AGS3 results) or TRET (AGS4 results)
     Enhanced with fallbacks for HOLE_ID and depths.
     """
-    # Get groups by priority
-    samp = groups.get("SAMP", pd.DataFrame()).copy()
-    clss = groups.get("CLSS", pd.DataFrame()).copy()
-    trig = groups.get("TRIG", pd.DataFrame()).copy()  # total stress general
-    treg = groups.get("TREG", pd.DataFrame()).copy()  # effective stress general
-    trix = groups.get("TRIX", pd.DataFrame()).copy()  # AGS3 results
-    tret = groups.get("TRET", pd.DataFrame()).copy()  # AGS4 results
+    # Get groups by priority. Shallow copies: only column labels and whole
+    # columns are replaced below, which never writes into the caller's frames.
+    samp = groups.get("SAMP", pd.DataFrame()).copy(deep=False)
+    clss = groups.get("CLSS", pd.DataFrame()).copy(deep=False)
+    trig = groups.get("TRIG", pd.DataFrame()).copy(deep=False)  # total stress general
+    treg = groups.get("TREG", pd.DataFrame()).copy(deep=False)  # effective stress general
+    trix = groups.get("TRIX", pd.DataFrame()).copy(deep=False)  # AGS3 results
+    tret = groups.get("TRET", pd.DataFrame()).copy(deep=False)  # AGS4 results
 
     # Normalize key columns for joins
     for df in [samp, clss, trig, treg, trix, tret]:
@@ -31,9 +32,10 @@ def generate_triaxial_table(groups: Dict[str, pd.DataFrame]) -> pd.DataFrame:
             to_numeric_safe(df, ["SAMP_TOP", "SAMP_BASE", "SPEC_DEPTH", "DEPTH_FROM", "DEPTH_TO"])
 
     # Step 1: Start with test results (TRIX/TRET priority)
-    trix_tret = pd.concat([trix, tret], ignore_index=True) if not trix.empty or not tret.empty else pd.DataFrame()
-    if trix_tret.empty:
+    results = [df for df in (trix, tret) if not df.empty]
+    if not results:
         return pd.DataFrame()  # No triaxial data
+    trix_tret = pd.concat(results, ignore_index=True) if len(results) > 1 else results[0]
 
     # Step 2: Join general test info (TRIG/TREG)
     trig_treg = pd.concat([trig, treg], ignore_index=True)
@@ -102,18 +104,18 @@ def remove_duplicate_tests(df: pd.DataFrame) -> pd.DataFrame:
     available_cols = [col for col in key_cols if col in df.columns]
 
     if len(available_cols) >= 3:
-        temp_df = df[available_cols].copy()
-        for col in temp_df.columns:
-            if pd.api.types.is_float_dtype(temp_df[col]):
-                temp_df[col] = temp_df[col].apply(lambda x: f"{x:.2f}" if not pd.isna(x) else "")
-            else:
-                temp_df[col] = temp_df[col].astype(str)
-
-        temp_df['combined'] = temp_df.apply(lambda row: '|'.join(row.values), axis=1)
-        mask = ~temp_df.duplicated(subset=['combined'], keep='first')
-        df = df[mask].reset_index(drop=True)
+        # Floats compare at 2 dp, everything else as text. duplicated() hashes the
+        # key columns directly instead of building a joined string per row.
+        keys = pd.DataFrame({
+            col: df[col].round(2) if pd.api.types.is_float_dtype(df[col]) else df[col].astype(str)
+            for col in available_cols
+        })
+        mask = ~keys.duplicated(keep='first')
+        df = df[mask.to_numpy()].reset_index(drop=True)
 
     return df
+
+
 def calculate_s_t_values(tri_df: pd.DataFrame) -> pd.DataFrame:
     """
     Calculate stress path parameters s and t for triaxial tests.
@@ -133,109 +135,94 @@ def calculate_s_t_values(tri_df: pd.DataFrame) -> pd.DataFrame:
         if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce')
     
+    # Work on plain float arrays: DEVF/2 is computed once and shared by t, s_total
+    # and s_effective, instead of each pandas expression building its own temporaries
+    n = len(df)
+    missing = np.full(n, np.nan)
+    cell = df['CELL'].to_numpy(dtype=float, na_value=np.nan) if 'CELL' in df.columns else missing
+    devf = df['DEVF'].to_numpy(dtype=float, na_value=np.nan) if 'DEVF' in df.columns else missing
+    pwpf = df['PWPF'].to_numpy(dtype=float, na_value=np.nan) if 'PWPF' in df.columns else missing
+
     # Calculate t (deviator stress / 2)
-    if 'DEVF' in df.columns:
-        df['t'] = df['DEVF'] / 2
-    else:
-        df['t'] = np.nan
+    t = devf / 2
     
     # Total mean stress s_total
-    if 'CELL' in df.columns and 'DEVF' in df.columns:
-        df['s_total'] = df['CELL'] + (df['DEVF'] / 2)
-    else:
-        df['s_total'] = np.nan
+    s_total = cell + t
     
     # Effective mean stress s_effective (needs pore pressure PWPF)
-    if all(c in df.columns for c in ['CELL', 'DEVF', 'PWPF']):
-        df['s_effective'] = (df['CELL'] - df['PWPF']) + (df['DEVF'] / 2)
-    else:
-        df['s_effective'] = np.nan
+    s_effective = (cell - pwpf) + t
     
     # Choose which s to use as primary 's' column (effective preferred if available)
-    df['s'] = df['s_effective'].fillna(df['s_total'])
+    has_eff = ~np.isnan(s_effective)
+    s_primary = np.where(has_eff, s_effective, s_total)
+    
+    # Optional: round to reasonable precision
+    df['t'] = np.round(t, 2)
+    df['s_total'] = np.round(s_total, 2)
+    df['s_effective'] = np.round(s_effective, 2)
+    df['s'] = np.round(s_primary, 2)
     
     # Flag source of s
     df['s_source'] = np.where(
-        df['s_effective'].notna(), 
+        has_eff,
         'Effective (CELL - PWPF + DEVF/2)',
-        np.where(df['s_total'].notna(), 'Total (CELL + DEVF/2)', 'Missing')
+        np.where(~np.isnan(s_total), 'Total (CELL + DEVF/2)', 'Missing')
     )
     
-    # Optional: round to reasonable precision
-    for col in ['s', 't', 's_total', 's_effective']:
-        if col in df.columns:
-            df[col] = df[col].round(2)
-    
     return df
 
-def generate_triaxial_with_lithology(
-    groups: Dict[str, pd.DataFrame],
-    giu_df: Optional[pd.DataFrame] = None,
-    hole_col: str = 'HOLE_ID',
-    depth_col: str = 'SPEC_DEPTH'
-) -> pd.DataFrame:
+def match_depth_intervals(
+    holes: pd.Series,
+    depths: pd.Series,
+    ref_holes: pd.Series,
+    ref_from: pd.Series,
+    ref_to: pd.Series,
+    suffix: bool = False,
+) -> np.ndarray:
     """
-    Generate triaxial summary table with attached lithology (from GEOL or GIU).
+    For each (hole, depth), the position of the first reference row (in reference
+    order) for the same hole whose DEPTH_FROM <= depth <= DEPTH_TO, or -1.
+    suffix=True matches reference holes that end with the hole ID (GIU IDs carry
+    a prefix). Vectorised per hole instead of re-scanning the reference per row.
     """
-    # Get base triaxial table
-    tri_df = generate_triaxial_table(groups)
-    if tri_df.empty:
-        return tri_df
-
-    # Normalize identifiers
-    tri_df[hole_col] = tri_df[hole_col].astype(str).str.strip().str.upper()
-    tri_df[depth_col] = pd.to_numeric(tri_df[depth_col], errors='coerce')
-
-    # Try GEOL group first (if present)
-    if 'GEOL' in groups and not groups['GEOL'].empty:
-        geol = groups['GEOL'].copy()
-        geol[hole_col] = geol[hole_col].astype(str).str.strip().str.upper()
-        to_numeric_safe(geol, ['DEPTH_FROM', 'DEPTH_TO'])
-
-        def map_from_geol(row):
-            h, d = row[hole_col], row[depth_col]
-            if pd.isna(h) or pd.isna(d):
-                return None
-            mask = (
-                (geol[hole_col] == h) &
-                (geol['DEPTH_FROM'] <= d) &
-                (geol['DEPTH_TO'] >= d)
-            )
-            match = geol.loc[mask]
-            if not match.empty:
-                desc = match['GEOL_DESC'].iloc[0]
-                leg = match.get('GEOL_LEG', pd.NA).iloc[0]
-                return f"{leg} - {desc}" if pd.notna(leg) else desc
-            return None
-
-        tri_df['LITH_GEOL'] = tri_df.apply(map_from_geol, axis=1)
-
-    # Fallback / supplement with GIU table
-    if giu_df is not None and not giu_df.empty:
-        giu = giu_df.copy()
-        giu[hole_col] = giu[hole_col].astype(str).str.strip().str.upper()
-        to_numeric_safe(giu, ['DEPTH_FROM', 'DEPTH_TO'])
-
-        def map_from_giu(row):
-            h, d = row[hole_col], row[depth_col]
-            if pd.isna(h) or pd.isna(d):
-                return None
-            mask = (
-                (giu[hole_col] == h) &
-                (giu['DEPTH_FROM'] <= d) &
-                (giu['DEPTH_TO'] >= d)
-            )
-            match = giu.loc[mask]
-            return match['LITH'].iloc[0] if not match.empty else None
-
-        tri_df['LITH_GIU'] = tri_df.apply(map_from_giu, axis=1)
-
-        # Prefer GEOL if available, else GIU
-        tri_df['LITH'] = tri_df['LITH_GEOL'].combine_first(tri_df['LITH_GIU'])
-        tri_df = tri_df.drop(columns=['LITH_GEOL', 'LITH_GIU'], errors='ignore')
-
-    elif 'LITH_GEOL' in tri_df.columns:
-        tri_df['LITH'] = tri_df['LITH_GEOL']
-        tri_df = tri_df.drop(columns=['LITH_GEOL'])
-
-    return tri_df
+    out = np.full(len(holes), -1, dtype=np.int64)
+    if len(holes) == 0 or len(ref_holes) == 0:
+        return out
+
+    depth_arr = pd.to_numeric(depths, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    ref_lo = pd.to_numeric(ref_from, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    ref_hi = pd.to_numeric(ref_to, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+    # Reference row positions per hole ID, each kept in reference order
+    ref_codes, ref_ids = pd.factorize(ref_holes)
+    order = np.argsort(ref_codes, kind="stable")
+    starts = np.searchsorted(ref_codes[order], np.arange(len(ref_ids) + 1))
+    ref_rows = {ref_ids[k]: order[starts[k]:starts[k + 1]] for k in range(len(ref_ids))}
+
+    if suffix:
+        # Every suffix of every reference ID -> its rows, so each test hole is
+        # one dict lookup instead of an endswith() scan over all reference IDs
+        by_suffix: Dict[str, list] = {}
+        for h, r in ref_rows.items():
+            h = str(h)
+            for i in range(len(h) + 1):
+                by_suffix.setdefault(h[i:], []).append(r)
+
+    codes, ids = pd.factorize(holes)
+    has_depth = ~np.isnan(depth_arr)
+    for k, hole in enumerate(ids):
+        if suffix:
+            parts = by_suffix.get(str(hole))
+            cand = np.sort(np.concatenate(parts)) if parts else None
+        else:
+            cand = ref_rows.get(hole)
+        if cand is None:
+            continue
+        rows = np.flatnonzero((codes == k) & has_depth)
+        if rows.size == 0:
+            continue
+        d = depth_arr[rows][:, None]
+        inside = (ref_lo[cand] <= d) & (ref_hi[cand] >= d)
+        hit = inside.any(axis=1)
+        out[rows[hit]] = cand[inside.argmax(axis=1)[hit]]
+    return out